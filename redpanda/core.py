@@ -1,22 +1,89 @@
 #!/usr/bin/env python3
-from io import StringIO
+from tempfile import SpooledTemporaryFile
 import pandas as pd
 import traceback
 import psycopg2
+import psycopg2.extras
 import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
 import sys
 import os
+import shutil
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import re
+import io
+import bz2
+import json
+import gzip
 import uuid
+from urllib.parse import quote, urlencode
 import logging
+import threading
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+try:
+    import connectorx as cx
+except ImportError:
+    cx = None
 
 S3_ACCEPTED_KWARGS = [
-    'ACL', 'Body', 'CacheControl ',  'ContentDisposition', 'ContentEncoding', 'ContentLanguage',
-    'ContentLength', 'ContentMD5', 'ContentType', 'Expires', 'GrantFullControl', 'GrantRead',
+    'ACL', 'CacheControl',  'ContentDisposition', 'ContentEncoding', 'ContentLanguage',
+    'ContentType', 'Expires', 'GrantFullControl', 'GrantRead',
     'GrantReadACP', 'GrantWriteACP', 'Metadata', 'ServerSideEncryption', 'StorageClass',
     'WebsiteRedirectLocation', 'SSECustomerAlgorithm', 'SSECustomerKey', 'SSECustomerKeyMD5',
-    'SSEKMSKeyId', 'RequestPayer', 'Tagging'
-]  # Available parameters for service: https://boto3.readthedocs.io/en/latest/reference/services/s3.html#S3.Client.put_object
+    'SSEKMSKeyId', 'RequestPayer', 'Tagging', 'ChecksumAlgorithm'
+]  # Available parameters for service: https://boto3.readthedocs.io/en/latest/reference/customizations/s3.html#boto3.s3.transfer.S3Transfer.ALLOWED_UPLOAD_ARGS
+# checksums S3 verifies per part of a multipart upload
+S3_CHECKSUM_ALGORITHMS = ['CRC32', 'CRC32C', 'SHA1', 'SHA256']
+
+# multipart uploads kick in above 8MB and send 16MB parts concurrently, the classic
+# client checksums every part as it is sent
+S3_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 ** 2,
+                                    multipart_chunksize=16 * 1024 ** 2,
+                                    max_concurrency=10,
+                                    use_threads=True,
+                                    preferred_transfer_client='classic')
+# enough pooled connections that the transfer threads never wait for a socket
+S3_MAX_POOL_CONNECTIONS = S3_TRANSFER_CONFIG.max_request_concurrency * 2
+FILE_FORMATS = ['csv', 'parquet']
+# COPY statements, identifiers and sql fragments are formatted in and values are bound
+COPY_CSV_TEMPLATE = ("copy {table} from %(source)s {manifest} delimiter %(delimiter)s ignoreheader 1 "
+                     "{compression} csv quote as %(quotechar)s dateformat %(dateformat)s "
+                     "timeformat %(timeformat)s {options};")
+COPY_PARQUET_TEMPLATE = "copy {table} from %(source)s {manifest} format as parquet {options};"
+# pandas csv compression: (file extension, redshift COPY option)
+CSV_COMPRESSIONS = {
+    None: ('', ''),
+    'gzip': ('.gz', 'gzip'),
+    'bz2': ('.bz2', 'bzip2')
+}
+# the default level 9 caps a single compression thread at ~10MB/s, level 1 is ~10x
+# faster and only slightly larger, so compression no longer bottlenecks the upload
+CSV_COMPRESSLEVEL = 1
+# rows per parquet row group, redshift splits the COPY work by row group
+PARQUET_ROW_GROUP_SIZE = 100_000
+# smallest row group used when splitting the rows over the cluster slices
+PARQUET_MIN_ROW_GROUP_SIZE = 50_000
+# frames smaller than this are inserted directly instead of staged in S3
+INSERT_MAX_BYTES = 1024 ** 2
+# rows per multi-row INSERT statement
+INSERT_PAGE_SIZE = 1000
+# fewest rows per file when a frame is split over several files for a manifest COPY
+MIN_PART_ROWS = 50_000
+# files larger than this are spooled to disk instead of being held in memory
+SPOOL_MAX_SIZE = 64 * 1024 ** 2
+# csv bytes buffered between the writer thread and the upload
+PIPE_BUFFER_SIZE = 32 * 1024 ** 2
+
+with open(os.path.join(os.path.dirname(__file__), 'redshift_reserve_words.txt')) as f:
+    REDSHIFT_RESERVED_WORDS = frozenset(line.strip().lower() for line in f)
 
 logging_config = {
     'logger_level': logging.INFO,
@@ -37,13 +104,221 @@ def set_log_level(level, mask_secrets=True):
     logger.setLevel(logging_config['logger_level'])
     logging_config['mask_secrets'] = mask_secrets
 
+_ACCESS_KEY_RE = re.compile(r"(?<=access_key_id ')([^']*)(?=')")
+_SECRET_KEY_RE = re.compile(r"(?<=secret_access_key ')([^']*)(?=')")
+_MASK = '*'*8
+# only plain reads are sent through connectorx's separate connection
+_READ_QUERY_RE = re.compile(r'\s*(select|with)\b', re.IGNORECASE)
+# select ... into creates a table, it must not run on that connection
+_INTO_RE = re.compile(r'\binto\b', re.IGNORECASE)
+
 def mask_aws_credentials(s):
     if logging_config['mask_secrets']:
-        import re
-        s = re.sub('(?<=access_key_id \')(.*)(?=\')', '*'*8, s)
-        s = re.sub('(?<=secret_access_key \')(.*)(?=\')', '*'*8, s)
+        s = _ACCESS_KEY_RE.sub(_MASK, s)
+        s = _SECRET_KEY_RE.sub(_MASK, s)
     return s
 
+###########
+#streaming#
+###########
+class CsvPipe(io.RawIOBase):
+    """Readable stream of a DataFrame serialized to csv by a background thread.
+
+    The writer blocks once `buffer_size` bytes are waiting to be read, so only a
+    bounded slice of the csv is held in memory at any time. If `tee` is given, the
+    writer also copies every chunk into that binary file.
+    """
+    def __init__(self, data_frame, buffer_size=PIPE_BUFFER_SIZE, tee=None, **to_csv_kwargs):
+        self._buffer = bytearray()
+        self._tee = tee
+        self._buffer_size = buffer_size
+        self._cond = threading.Condition()
+        self._done = False
+        self._error = None
+        self.bytes_read = 0
+        self._thread = threading.Thread(target=self._produce,
+                                        args=(data_frame, to_csv_kwargs),
+                                        daemon=True)
+        self._thread.start()
+
+    def _produce(self, data_frame, to_csv_kwargs):
+        try:
+            sink = _PipeWriter(self)
+            # to_csv expands categoricals back to object arrays chunk by chunk, so
+            # converting repetitive string columns first measured slower, not faster
+            if not _arrow_to_csv(data_frame, sink, **to_csv_kwargs):
+                data_frame.to_csv(sink, **to_csv_kwargs)
+        except BaseException as e:
+            self._error = e
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def _write(self, b):
+        if self._tee is not None:
+            self._tee.write(b)
+        with self._cond:
+            while len(self._buffer) >= self._buffer_size and not self.closed:
+                self._cond.wait()
+            if self.closed:
+                raise BrokenPipeError('csv pipe closed by reader')
+            self._buffer += b
+            self._cond.notify_all()
+        return len(b)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        with self._cond:
+            while not self._buffer and not self._done:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+            n = min(len(b), len(self._buffer))
+            b[:n] = self._buffer[:n]
+            del self._buffer[:n]
+            self.bytes_read += n
+            self._cond.notify_all()
+        return n
+
+    def close(self):
+        with self._cond:
+            super().close()
+            self._cond.notify_all()
+        self._thread.join()
+
+class _PipeWriter(io.RawIOBase):
+    # write end handed to to_csv, which wraps it in a utf-8 text layer
+    def __init__(self, pipe):
+        self._pipe = pipe
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self._pipe._write(bytes(b))
+
+###############
+#dtype mapping#
+###############
+# redshift column type per numpy dtype kind, anything else is stored as text
+_KIND_TO_RS = {'i': 'INTEGER', 'u': 'INTEGER', 'f': 'REAL', 'M': 'TIMESTAMP', 'b': 'BOOLEAN'}
+
+def _redshift_dtype(dtype):
+    if isinstance(dtype, pd.SparseDtype):
+        dtype = dtype.subtype
+    # 64 bit ints, and unsigned ints that overflow a signed INTEGER, need a BIGINT
+    if (dtype.kind == 'i' and dtype.itemsize == 8) or (dtype.kind == 'u' and dtype.itemsize >= 4):
+        return 'BIGINT'
+    # parquet doubles only load into DOUBLE PRECISION, and REAL would truncate them anyway
+    if dtype.kind == 'f' and dtype.itemsize == 8:
+        return 'DOUBLE PRECISION'
+    return _KIND_TO_RS.get(dtype.kind, 'VARCHAR(256)')
+
+def _rows_to_frame(rows, columns):
+    # pandas transposes a list of row tuples into typed columns in cython; building the
+    # columns in python first (zip(*rows) + np.asarray per column) measured slower
+    return pd.DataFrame(rows, columns=columns)
+
+# dtype kinds the pyarrow csv writer formats the way redshift reads them, categoricals
+# (kind 'O') are written from their dictionary
+_ARROW_CSV_KINDS = set('iufbMO')
+
+def _arrow_csv_dtype(dtype):
+    # of the pandas extension dtypes only strings, categoricals and the nullable
+    # numbers/booleans are written as plain values; period, interval, sparse, ... are not
+    if isinstance(dtype, pd.api.extensions.ExtensionDtype):
+        return (isinstance(dtype, (pd.StringDtype, pd.CategoricalDtype)) or
+                (dtype.kind in 'iufb' and not isinstance(dtype, pd.SparseDtype)))
+    return dtype.kind in _ARROW_CSV_KINDS
+
+def _arrow_csv_writable(arrow_type):
+    # object columns can hold lists, dicts, bytes or uuids, which write_csv refuses
+    if pa.types.is_dictionary(arrow_type):
+        arrow_type = arrow_type.value_type
+    return not (isinstance(arrow_type, pa.ExtensionType) or pa.types.is_nested(arrow_type) or
+                pa.types.is_binary(arrow_type) or pa.types.is_large_binary(arrow_type) or
+                pa.types.is_fixed_size_binary(arrow_type))
+
+def _arrow_redshift_dtype(arrow_type):
+    # parquet columns only load into the redshift type matching their arrow type,
+    # None when there is none and the column has to be written as a string
+    if pa.types.is_dictionary(arrow_type):
+        arrow_type = arrow_type.value_type
+    if (pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type) or
+            pa.types.is_boolean(arrow_type) or pa.types.is_timestamp(arrow_type)):
+        return _redshift_dtype(pd.api.types.pandas_dtype(arrow_type.to_pandas_dtype()))
+    if pa.types.is_date32(arrow_type):
+        return 'DATE'
+    if pa.types.is_decimal128(arrow_type) and arrow_type.scale >= 0:
+        return f'DECIMAL({arrow_type.precision},{arrow_type.scale})'
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return 'VARCHAR(256)'
+    return None
+
+def _parquet_schema(schema):
+    # all null object columns, times, uuids, ... are written as strings
+    for i, field in enumerate(schema):
+        if _arrow_redshift_dtype(field.type) is None:
+            schema = schema.set(i, field.with_type(pa.string()))
+    return schema
+
+def _s3_extra_kwargs(kwargs):
+    extra_kwargs = {k: v for k, v in kwargs.items() if k in S3_ACCEPTED_KWARGS and v is not None}
+    if extra_kwargs.get('ChecksumAlgorithm', 'CRC32') not in S3_CHECKSUM_ALGORITHMS:
+        raise ValueError('ChecksumAlgorithm must be one of {0}'.format(S3_CHECKSUM_ALGORITHMS))
+    return extra_kwargs
+
+def _file_extension(fmt, compression):
+    if fmt not in FILE_FORMATS:
+        raise ValueError("fmt must be either 'csv' or 'parquet'")
+    if compression not in CSV_COMPRESSIONS:
+        raise ValueError("compression must be either None, 'gzip' or 'bz2'")
+    if fmt == 'parquet':
+        return '.parquet'
+    return '.csv' + CSV_COMPRESSIONS[compression][0]
+
+def _arrow_to_csv(data_frame, fileobj, index=True, sep=',', compression=None, **kwargs):
+    """Write the csv with pyarrow's multithreaded writer, if pyarrow is installed.
+
+    Returns False without writing anything when the frame has to go through pandas.
+    """
+    if pa is None:
+        return False
+    if index:
+        data_frame = data_frame.reset_index()
+    if any(not _arrow_csv_dtype(dtype) or getattr(dtype, 'tz', None) is not None
+           for dtype in data_frame.dtypes):
+        return False
+    try:
+        table = pa.Table.from_pandas(data_frame, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, TypeError):
+        # e.g. object columns holding mixed python types
+        return False
+    if not all(_arrow_csv_writable(field.type) for field in table.schema):
+        return False
+    # redshift timestamps have microsecond precision
+    for i, field in enumerate(table.schema):
+        if pa.types.is_timestamp(field.type) and field.type.unit == 'ns':
+            table = table.set_column(i, field.name,
+                                     table.column(i).cast(pa.timestamp('us'), safe=False))
+    write_options = pa_csv.WriteOptions(delimiter=sep)
+    # write_csv checks every column type before writing a row, so a type it cannot
+    # write is caught here, before anything has gone into the pipe
+    try:
+        pa_csv.write_csv(table.slice(0, 0), io.BytesIO(), write_options=write_options)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return False
+    if compression is None:
+        pa_csv.write_csv(table, fileobj, write_options=write_options)
+    else:
+        opener = gzip.open if compression['method'] == 'gzip' else bz2.open
+        with opener(fileobj, 'wb', compresslevel=compression['compresslevel']) as f:
+            pa_csv.write_csv(table, f, write_options=write_options)
+    return True
+
 ##############
 #config types#
 ##############
@@ -67,9 +342,13 @@ class S3Config:
     token: str = None
 
 class RedPanda:
-    def __init__(self,redshiftconfig,s3config=None):
+    def __init__(self,redshiftconfig,s3config=None,fast_query=False):
         self.redshiftconf = redshiftconfig
         self.s3conf = s3config
+        # connectorx reads on its own connection, without this session's state, so it is opt-in
+        if fast_query and cx is None:
+            raise ImportError('fast_query=True requires connectorx')
+        self.fast_query = fast_query
         
         self._connect_to_redshift()
         if s3config is not None:
@@ -88,51 +367,106 @@ class RedPanda:
                                    password=cfg.password,
                                    **kwargs)
         self.cursor = self.connect.cursor()
+        # connectorx can only be given the libpq options that fit in its url
+        self._connect_options = kwargs
+        self._fast_query_enabled = (self.fast_query and
+                                    all(isinstance(v, (str, int)) for v in kwargs.values()))
 
     def _connect_to_s3(self,**kwargs):
         assert (self.s3conf is not None),"No s3 config provided"
+        kwargs.setdefault('config', Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
         self.s3 = boto3.resource('s3',
                             aws_access_key_id=self.s3conf.access_key,
                             aws_secret_access_key=self.s3conf.secret_access_key,
                             **kwargs)
+        # one client and transfer manager for every upload, sharing the connection pool
+        self.s3_client = self.s3.meta.client
+        self.transfer = create_transfer_manager(self.s3_client, S3_TRANSFER_CONFIG)
 
     def query(self,sql_query, query_params=None):
         # pass a sql query and return a pandas dataframe
+        # connectorx uses its own connection, so it would not see an open transaction
+        if (self._fast_query_enabled and query_params is None and
+                _READ_QUERY_RE.match(sql_query) and not _INTO_RE.search(sql_query) and
+                self.connect.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+            try:
+                return self._fast_query(sql_query)
+            except Exception as e:
+                # a bad query is raised as is, only when connectorx can't connect at all
+                # is it turned off, and the query (which never ran) goes to the cursor
+                try:
+                    self._fast_query('select 1')
+                except Exception:
+                    self._fast_query_enabled = False
+                    logger.warning(f'connectorx could not connect, using the cursor for all queries: {e}')
+                else:
+                    raise
         self.cursor.execute(sql_query, query_params)
         columns_list = [desc[0] for desc in self.cursor.description]
-        data = pd.DataFrame(self.cursor.fetchall(), columns=columns_list)
+        data = _rows_to_frame(self.cursor.fetchall(), columns_list)
         return data
 
+    def _fast_query(self, sql_query):
+        # connectorx fetches the result into columnar buffers without a python object per value
+        cfg = self.redshiftconf
+        conn_url = 'redshift://{0}:{1}@{2}:{3}/{4}'.format(
+            quote(cfg.user, safe=''), quote(cfg.password, safe=''), cfg.host, cfg.port, cfg.database)
+        if self._connect_options:
+            conn_url += '?' + urlencode(self._connect_options)
+        return cx.read_sql(conn_url, sql_query, return_type='pandas')
+
+    def query_iter(self, sql_query, query_params=None, chunksize=10_000):
+        """Run a sql query and yield the result as pandas dataframes of at most chunksize rows.
+
+        The rows are read through a server side cursor, so only one chunk is held in memory.
+        """
+        cursor = self.connect.cursor(name=f'rp_{uuid.uuid4().hex}')
+        cursor.itersize = chunksize
+        try:
+            cursor.execute(sql_query, query_params)
+            rows = cursor.fetchmany(chunksize)
+            # a named cursor only has a description after the first fetch
+            columns_list = [desc[0] for desc in cursor.description]
+            yield _rows_to_frame(rows, columns_list)
+            while len(rows) == chunksize:
+                rows = cursor.fetchmany(chunksize)
+                if rows:
+                    yield _rows_to_frame(rows, columns_list)
+        finally:
+            cursor.close()
+
     def validate_column_names(self,data_frame):
         """Validate the column names to ensure no reserved words are used.
 
         Arguments:
             dataframe pd.data_frame -- data to validate
         """
-        rrwords = open(os.path.join(os.path.dirname(__file__),
-                                    'redshift_reserve_words.txt'), 'r').readlines()
-        rrwords = [r.strip().lower() for r in rrwords]
-
-        data_frame.columns = [x.lower() for x in data_frame.columns]
-
-        for col in data_frame.columns:
-            try:
-                assert col not in rrwords
-            except AssertionError:
-                raise ValueError(
-                    'DataFrame column name {0} is a reserve word in redshift'
-                    .format(col))
-
-        # check for spaces in the column names
-        there_are_spaces = sum(
-            [re.search('\s', x) is not None for x in data_frame.columns]) > 0
-        # delimit them if there are
-        if there_are_spaces:
-            col_names_dict = {x: '"{0}"'.format(x) for x in data_frame.columns}
-            data_frame.rename(columns=col_names_dict, inplace=True)
+        if len(data_frame.columns) == 0:
+            return data_frame
+        # .str would silently turn non-string labels into NaN
+        if data_frame.columns.inferred_type != 'string':
+            raise ValueError('DataFrame column names must be strings, got {0}'
+                             .format(data_frame.columns.tolist()))
+        data_frame.columns = data_frame.columns.str.lower()
+
+        reserved = data_frame.columns.isin(REDSHIFT_RESERVED_WORDS)
+        if reserved.any():
+            raise ValueError(
+                'DataFrame column names {0} are reserve words in redshift'
+                .format(data_frame.columns[reserved].tolist()))
+
+        # delimit the column names that contain spaces
+        has_spaces = data_frame.columns.str.contains(r'\s', regex=True)
+        if has_spaces.any():
+            data_frame.columns = data_frame.columns.where(
+                ~has_spaces, '"' + data_frame.columns + '"')
         return data_frame
 
-    def df_to_s3(self,data_frame, csv_name, index, save_local, delimiter, verbose=True, **kwargs):
+    def _upload_to_s3(self, fileobj, key, extra_kwargs):
+        self.transfer.upload(fileobj, self.s3conf.bucket, key, extra_args=extra_kwargs).result()
+
+    def df_to_s3(self,data_frame, csv_name, index, save_local, delimiter, verbose=True, fmt='csv',
+                 compression=None, slices=None, schema=None, **kwargs):
         """Write a dataframe to S3
 
         Arguments:
@@ -140,43 +474,123 @@ class RedPanda:
             csv_name str -- name of the file to upload
             save_local bool -- save a local copy
             delimiter str -- delimiter for csv file
+            fmt str -- file format, 'csv' or 'parquet'
+            compression str -- compression of the csv file, None, 'gzip' or 'bz2'
+            slices int -- number of slices in the cluster, sizes the parquet row groups
+            schema pa.Schema -- arrow schema of the parquet file, defaults to the frame's
+
+        Returns the size of the uploaded file in bytes.
+        """
+        _file_extension(fmt, compression)
+        extra_kwargs = _s3_extra_kwargs(kwargs)
+        key = self.s3conf.subdirectory + csv_name
+        if fmt == 'parquet':
+            if pa is None:
+                raise ImportError("fmt='parquet' requires pyarrow")
+            if index:
+                # redshift maps parquet columns by position, the index goes first
+                data_frame = data_frame.reset_index()
+            table = pa.Table.from_pandas(data_frame, preserve_index=False)
+            table = table.cast(schema or _parquet_schema(table.schema))
+            if slices:
+                # one row group per slice lets every slice load in parallel
+                row_group_size = max(len(data_frame) // slices, PARQUET_MIN_ROW_GROUP_SIZE)
+            else:
+                row_group_size = PARQUET_ROW_GROUP_SIZE
+            # the parquet footer is only known at the end, so the file is staged
+            # in a spooled file rather than streamed
+            with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+b') as parquet_buffer:
+                pq.write_table(table, parquet_buffer, row_group_size=row_group_size,
+                               compression='snappy', use_dictionary=True,
+                               coerce_timestamps='us', allow_truncated_timestamps=True)
+                # create local backup
+                if save_local:
+                    parquet_buffer.seek(0)
+                    with open(csv_name, 'wb') as f:
+                        shutil.copyfileobj(parquet_buffer, f)
+                    if verbose:
+                        logger.info(f'saved file {csv_name} in {os.getcwd()}')
+                size = parquet_buffer.tell()
+                parquet_buffer.seek(0)
+                self._upload_to_s3(parquet_buffer, key, extra_kwargs)
+        else:
+            # stream the csv into the upload while it is being written, the local
+            # backup is written from the same bytes
+            local_file = open(csv_name, 'wb') if save_local else contextlib.nullcontext()
+            if compression is not None:
+                compression = {'method': compression, 'compresslevel': CSV_COMPRESSLEVEL}
+            with local_file as tee, CsvPipe(data_frame, tee=tee, index=index, sep=delimiter,
+                                            chunksize=10_000, compression=compression) as pipe:
+                self._upload_to_s3(io.BufferedReader(pipe), key, extra_kwargs)
+                size = pipe.bytes_read
+            if save_local and verbose:
+                logger.info(f'saved file {csv_name} in {os.getcwd()}')
+        if verbose:
+            logger.info(f'saved file {csv_name} in bucket {key}')
+        return size
+
+    def df_to_s3_manifest(self, data_frame, file_name, parts, index, save_local, delimiter,
+                          verbose=True, fmt='csv', compression=None, schema=None, **kwargs):
+        """Write a dataframe to S3 split over several files, listed in a COPY manifest
+
+        Redshift loads every file of a manifest on a different slice, in parallel.
+
+        Arguments:
+            dataframe pd.data_frame -- data to upload
+            file_name str -- name of the manifest, the files are named after it
+            parts int -- number of files to split the rows over
+            save_local bool -- save a local copy of the files
+            delimiter str -- delimiter for csv file
+            fmt str -- file format, 'csv' or 'parquet'
+            compression str -- compression of the csv file, None, 'gzip' or 'bz2'
+            schema pa.Schema -- arrow schema shared by the parquet files
+
+        Returns the name of the manifest file.
         """
-        extra_kwargs = {k: v for k, v in kwargs.items(
-        ) if k in S3_ACCEPTED_KWARGS and v is not None}
-        # create local backup
-        if save_local:
-            data_frame.to_csv(csv_name, index=index, sep=delimiter)
-            if verbose:
-                logger.info(f'saved file {csv_name} in {os.getcwd}')
-        #
-        csv_buffer = StringIO()
-        data_frame.to_csv(csv_buffer, index=index, sep=delimiter)
-        self.s3.Bucket(self.s3conf.bucket).put_object(
-            Key=self.s3conf.subdirectory + csv_name, Body=csv_buffer.getvalue(),
-            **extra_kwargs)
+        extension = _file_extension(fmt, compression)
+        bounds = [len(data_frame) * i // parts for i in range(parts + 1)]
+        part_names = [f'{file_name}.part{i}{extension}' for i in range(parts)]
+
+        # boto3 clients are thread safe, the parts share the connection's client
+        def upload_part(i):
+            return self.df_to_s3(data_frame.iloc[bounds[i]:bounds[i + 1]], part_names[i], index,
+                                 save_local, delimiter, verbose=verbose, fmt=fmt,
+                                 compression=compression, schema=schema, **kwargs)
+        # the transfer manager only reads this many uploads at once, more workers would
+        # leave pipes idle with a full PIPE_BUFFER_SIZE buffer each
+        max_workers = min(parts, S3_TRANSFER_CONFIG.max_submission_concurrency)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            sizes = list(executor.map(upload_part, range(parts)))
+
+        # content_length is required in the manifest for parquet files
+        manifest = {'entries': [
+            {'url': 's3://{0}/{1}'.format(self.s3conf.bucket, self.s3conf.subdirectory + name),
+             'mandatory': True,
+             'meta': {'content_length': size}}
+            for name, size in zip(part_names, sizes)]}
+        manifest_name = file_name + '.manifest'
+        extra_kwargs = _s3_extra_kwargs(kwargs)
+        self._upload_to_s3(io.BytesIO(json.dumps(manifest).encode()),
+                           self.s3conf.subdirectory + manifest_name, extra_kwargs)
         if verbose:
-            logger.info(f'saved file {csv_name} in bucket {self.s3conf.subdirectory + csv_name}')
+            logger.info(f'saved manifest {manifest_name} listing {parts} files')
+        return manifest_name
 
     def pd_dtype_to_redshift_dtype(self,dtype):
-        if dtype.startswith('int64'):
-            return 'BIGINT'
-        elif dtype.startswith('int'):
-            return 'INTEGER'
-        elif dtype.startswith('float'):
-            return 'REAL'
-        elif dtype.startswith('datetime'):
-            return 'TIMESTAMP'
-        elif dtype == 'bool':
-            return 'BOOLEAN'
-        else:
-            return 'VARCHAR(256)'
+        return _redshift_dtype(pd.api.types.pandas_dtype(dtype))
+
+    def get_column_names(self,data_frame, index=False):
+        columns = list(data_frame.columns)
+        if index:
+            columns.insert(0, data_frame.index.name or 'index')
+        return columns
 
     def get_column_data_types(self,data_frame, index=False):
-        column_data_types = [self.pd_dtype_to_redshift_dtype(dtype.name)
-                             for dtype in data_frame.dtypes.values]
+        # wide frames have few distinct dtypes, map each of them only once
+        dtypes = data_frame.dtypes
+        column_data_types = dtypes.map({d: _redshift_dtype(d) for d in set(dtypes)}).tolist()
         if index:
-            column_data_types.insert(
-                0, self.pd_dtype_to_redshift_dtype(data_frame.index.dtype.name))
+            column_data_types.insert(0, _redshift_dtype(data_frame.index.dtype))
         return column_data_types
 
     def create_redshift_table(self,
@@ -189,25 +603,18 @@ class RedPanda:
                               distkey='',
                               sort_interleaved=False,
                               sortkey='',
-                              verbose=True):
+                              verbose=True,
+                              columns=None):
         """Create an empty RedShift Table
 
         """
-        if index:
-            columns = list(data_frame.columns)
-            if data_frame.index.name:
-                columns.insert(0, data_frame.index.name)
-            else:
-                columns.insert(0, "index")
-        else:
-            columns = list(data_frame.columns)
+        if columns is None:
+            columns = self.get_column_names(data_frame, index)
         if column_data_types is None:
             column_data_types = self.get_column_data_types(data_frame, index)
-        columns_and_data_type = ', '.join(
-            ['{0} {1}'.format(x, y) for x, y in zip(columns, column_data_types)])
+        columns_and_data_type = ', '.join(f'{x} {y}' for x, y in zip(columns, column_data_types))
 
-        create_table_query = 'create table {0} ({1})'.format(
-            redshift_table_name, columns_and_data_type)
+        create_table_query = f'create table {redshift_table_name} ({columns_and_data_type})'
         if not distkey:
             # Without a distkey, we can set a diststyle
             if diststyle not in ['even', 'all']:
@@ -228,49 +635,72 @@ class RedPanda:
         self.cursor.execute(create_table_query)
         self.connect.commit()
 
-    def s3_to_redshift(self,redshift_table_name, csv_name, delimiter=',', quotechar='"',
-                       dateformat='auto', timeformat='auto', region='', parameters='', verbose=True):
-
-        bucket_name = 's3://{0}/{1}'.format(
-            self.s3conf.bucket, self.s3conf.subdirectory + csv_name)
-
-        aws1 = self.s3conf.access_key
-        aws2 = self.s3conf.secret_access_key
-        aws_role = self.s3conf.iam_role
-        if aws1 and aws2:
-            authorization = f"""
-            access_key_id '{aws1}'
-            secret_access_key '{aws2}'
-            """
-        elif aws_role:
-            authorization = f"""
-            iam_role '{aws_role}'
-            """
+    def _copy_authorization(self, params):
+        # adds the credentials to the COPY parameters and returns the clause binding them
+        if self.s3conf.access_key and self.s3conf.secret_access_key:
+            params['access_key_id'] = self.s3conf.access_key
+            params['secret_access_key'] = self.s3conf.secret_access_key
+            authorization = 'access_key_id %(access_key_id)s secret_access_key %(secret_access_key)s'
+        elif self.s3conf.iam_role:
+            params['iam_role'] = self.s3conf.iam_role
+            authorization = 'iam_role %(iam_role)s'
         else:
-            authorization = ""
-
-        s3_to_sql = f"""
-        copy {redshift_table_name}
-        from '{bucket_name}'
-        delimiter '{delimiter}'
-        ignoreheader 1
-        csv quote as '{quotechar}'
-        dateformat '{dateformat}'
-        timeformat '{timeformat}'
-        {authorization}
-        {parameters}
-        """
-        if region:
-            s3_to_sql += f"region '{region}'"
+            authorization = ''
         if self.s3conf.token:
-            s3_to_sql += f"\n\tsession_token '{self.s3conf.token}'"
-        s3_to_sql = s3_to_sql + ';'
+            params['session_token'] = self.s3conf.token
+            authorization += ' session_token %(session_token)s'
+        return authorization
+
+    def s3_to_redshift(self,redshift_table_name, csv_name, delimiter=',', quotechar='"',
+                       dateformat='auto', timeformat='auto', region='', parameters='', verbose=True,
+                       fmt='csv', compression=None, manifest=False):
+
+        params = {
+            'source': 's3://{0}/{1}'.format(self.s3conf.bucket, self.s3conf.subdirectory + csv_name),
+            'delimiter': delimiter,
+            'quotechar': quotechar,
+            'dateformat': dateformat,
+            'timeformat': timeformat
+        }
+        options = [self._copy_authorization(params), parameters.replace('%', '%%')]
+        if region:
+            options.append('region %(region)s')
+            params['region'] = region
+        # parquet is typed and self-describing, the csv options do not apply
+        template = COPY_PARQUET_TEMPLATE if fmt == 'parquet' else COPY_CSV_TEMPLATE
+        s3_to_sql = template.format(table=redshift_table_name.replace('%', '%%'),
+                                    manifest='manifest' if manifest else '',
+                                    compression=CSV_COMPRESSIONS[compression][1],
+                                    options=' '.join(o for o in options if o))
         if verbose:
-            logger.info(mask_aws_credentials(s3_to_sql))
+            logger.info(mask_aws_credentials(self.cursor.mogrify(s3_to_sql, params).decode()))
             # send the file
             logger.info('FILLING THE TABLE IN REDSHIFT')
         try:
-            self.cursor.execute(s3_to_sql)
+            self.cursor.execute(s3_to_sql, params)
+            self.connect.commit()
+        except Exception as e:
+            logger.error(e)
+            traceback.print_exc(file=sys.stdout)
+            self.connect.rollback()
+            raise
+
+    def df_to_redshift_insert(self, data_frame, redshift_table_name, index=False, verbose=True):
+        """Insert a dataframe into an existing table with multi-row INSERT statements
+
+        Redshift cannot COPY from STDIN, so this is the way to skip the S3 round trip
+        for small frames.
+        """
+        if index:
+            data_frame = data_frame.reset_index()
+        # psycopg2 cannot adapt numpy scalars or NaN as NULL, box the values as python objects
+        values = data_frame.astype(object).where(data_frame.notna(), None)
+        if verbose:
+            logger.info(f'INSERTING {len(values)} ROWS IN REDSHIFT')
+        try:
+            psycopg2.extras.execute_values(
+                self.cursor, f'insert into {redshift_table_name} values %s',
+                values.itertuples(index=False, name=None), page_size=INSERT_PAGE_SIZE)
             self.connect.commit()
         except Exception as e:
             logger.error(e)
@@ -279,12 +709,10 @@ class RedPanda:
             raise
 
     def exists(self,table):
-        query = (f"SELECT EXISTS ("
-                 f"SELECT * FROM information_schema.tables "
-                 f"WHERE  table_schema = '{self.redshiftconf.schema}'"
-                 f"AND    table_name   = '{table.lower()}');")
-        self.cursor.execute(query)
-        return self.cursor.fetchall()[0][0]
+        self.cursor.execute("SELECT 1 FROM pg_catalog.pg_tables "
+                            "WHERE schemaname = %s AND tablename = %s LIMIT 1;",
+                            (self.redshiftconf.schema, table.lower()))
+        return self.cursor.fetchone() is not None
 
     def pandas_to_redshift(self,
                            data_frame,
@@ -305,25 +733,67 @@ class RedPanda:
                            parameters='',
                            verbose=True,
                            overwritre=False,
+                           fmt='csv',
+                           compression='gzip',
+                           slices=None,
+                           insert_max_bytes=INSERT_MAX_BYTES,
                            **kwargs):
         
         # Validate column names.
         data_frame = self.validate_column_names(data_frame)
-        # Send data to S3
-        csv_name = '{}-{}.csv'.format(redshift_table_name, uuid.uuid4())
-        s3_kwargs = {k: v for k, v in kwargs.items()
-            if k in S3_ACCEPTED_KWARGS and v is not None}
-        self.df_to_s3(data_frame, csv_name, index, save_local, delimiter, verbose=verbose, **s3_kwargs)
+        s3_kwargs = _s3_extra_kwargs(kwargs)
+        # small frames are cheaper to insert directly than to stage in S3, but only when
+        # no COPY or S3 option would be dropped by doing so
+        copy_defaults = (not save_local and fmt == 'csv' and compression == 'gzip' and
+                         delimiter == ',' and quotechar == '"' and dateformat == 'auto' and
+                         timeformat == 'auto' and not region and not parameters and not s3_kwargs)
+        # the shallow size is checked first since the deep one walks every object
+        stage_in_s3 = (not copy_defaults or
+                       data_frame.memory_usage(index=index).sum() >= insert_max_bytes or
+                       data_frame.memory_usage(index=index, deep=True).sum() >= insert_max_bytes)
+        schema = None
+        if fmt == 'parquet':
+            if pa is None:
+                raise ImportError("fmt='parquet' requires pyarrow")
+            # the table is typed from the arrow schema of the whole frame, which every
+            # file is cast to, so parts inferring e.g. a narrower decimal still load
+            schema = _parquet_schema(pa.Schema.from_pandas(
+                data_frame.reset_index() if index else data_frame, preserve_index=False))
+            if column_data_types is None:
+                column_data_types = [_arrow_redshift_dtype(field.type) for field in schema]
+        if stage_in_s3:
+            # Send data to S3
+            file_name = '{}-{}'.format(redshift_table_name, uuid.uuid4())
+            # split large frames into a file per slice so the COPY runs on all of them
+            parts = min(slices or 1, len(data_frame) // MIN_PART_ROWS)
+            if parts > 1:
+                csv_name = self.df_to_s3_manifest(data_frame, file_name, parts, index, save_local,
+                                                  delimiter, verbose=verbose, fmt=fmt,
+                                                  compression=compression, schema=schema,
+                                                  **s3_kwargs)
+            else:
+                csv_name = file_name + _file_extension(fmt, compression)
+                self.df_to_s3(data_frame, csv_name, index, save_local, delimiter, verbose=verbose,
+                              fmt=fmt, compression=compression, slices=slices, schema=schema,
+                              **s3_kwargs)
 
         # CREATE AN EMPTY TABLE IN REDSHIFT
         if not append:
+            columns = self.get_column_names(data_frame, index)
+            if column_data_types is None:
+                column_data_types = self.get_column_data_types(data_frame, index)
             self.create_redshift_table(data_frame, redshift_table_name,
                                   column_data_types, index, append,
-                                  diststyle, distkey, sort_interleaved, sortkey, verbose=verbose)
-
-        # CREATE THE COPY STATEMENT TO SEND FROM S3 TO THE TABLE IN REDSHIFT
-        self.s3_to_redshift(redshift_table_name, csv_name, delimiter, quotechar,
-                       dateformat, timeformat, region, parameters, verbose=verbose)
+                                  diststyle, distkey, sort_interleaved, sortkey, verbose=verbose,
+                                  columns=columns)
+
+        if stage_in_s3:
+            # CREATE THE COPY STATEMENT TO SEND FROM S3 TO THE TABLE IN REDSHIFT
+            self.s3_to_redshift(redshift_table_name, csv_name, delimiter, quotechar,
+                                dateformat, timeformat, region, parameters, verbose=verbose,
+                                fmt=fmt, compression=compression, manifest=parts > 1)
+        else:
+            self.df_to_redshift_insert(data_frame, redshift_table_name, index, verbose=verbose)
         
     def put(self,df,table,append=False):
         self.pandas_to_redshift(df,self.redshiftconf.schema+'.'+table,append=append)
@@ -334,6 +804,8 @@ class RedPanda:
     def close(self):
         self.cursor.close()
         self.connect.commit()
+        if self.s3conf is not None:
+            self.transfer.shutdown()
 
     def __enter__(self):
         return self
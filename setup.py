@@ -11,6 +11,8 @@ setup(
     python_requires='>=3',
     install_requires=['psycopg2-binary',
                       'pandas',
-                      'boto3'],
+                      'boto3>=1.33.0'],
+    extras_require={'parquet': ['pyarrow'],
+                    'fast': ['connectorx']},
     include_package_data=True
 )